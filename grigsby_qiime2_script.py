@@ -1,12 +1,93 @@
 #!/usr/bin/env python3
 
 import os
+import stat
+import argparse
+import asyncio
 import subprocess
-import time
 import sys
+import json
+import gzip
+import io
+import hashlib
+import shlex
+import shutil
+import signal
+import tempfile
+import time
 import webbrowser
 import threading
-import itertools
+import functools
+import collections
+import concurrent.futures
+import contextlib
+from dataclasses import dataclass, field
+import importlib.util
+
+# CPUs this process may run on, which inside a SLURM job or a taskset is fewer than the machine has
+try:
+    AVAILABLE_CPUS = len(os.sched_getaffinity(0))
+except AttributeError:
+    AVAILABLE_CPUS = os.cpu_count() or 4
+
+# Default number of threads/jobs passed to the QIIME2 actions that support them
+NTHREADS = str(AVAILABLE_CPUS)
+
+# Number of trailing stderr lines kept from each command for error reporting
+STDERR_TAIL_LINES = 500
+
+# Size of each read from a command's stderr pipe
+STDERR_READ_SIZE = 1 << 16
+
+# Whether output is going to a terminal, rather than being redirected to a log file or pipe
+INTERACTIVE = sys.stdout.isatty()
+
+# Size of the stdout buffer used when output is redirected to a log file or pipe
+LOG_BUFFER_SIZE = 1 << 16
+
+# Plain-text message formats used instead of emoji when output is not going to a terminal
+PLAIN_MESSAGE_FORMATS = {
+    "info": "{}",
+    "success": "SUCCESS: {}",
+    "running": "Running: {}",
+    "warning": "WARNING: {}",
+    "error": "ERROR: {}",
+    "input": "? {}",
+    "skip": "SKIPPING: {} (files already exist)",
+}
+
+# Set from --batch-manifest: when set, commands are submitted as SLURM array jobs
+# listed in this JSON Lines manifest instead of being run locally
+BATCH_MANIFEST = None
+
+# Set from --emit-plan: when set, every batch of commands is also written to this
+# bash script, so the run can be repeated from a shell without this script
+PLAN_SCRIPT = None
+
+# CPUs requested for each command run through SLURM, set from --threads
+BATCH_CPUS_PER_TASK = NTHREADS
+
+# When running inside a SLURM allocation, commands are launched as separate job steps with srun
+# so that concurrent steps are spread over the allocated cores (and nodes). Not inside a job step
+# (e.g. `srun --pty bash`), whose CPUs a nested exclusive step would wait on forever; --no-srun
+# turns it off too
+SRUN = shutil.which("srun") if "SLURM_JOB_ID" in os.environ and "SLURM_STEP_ID" not in os.environ else None
+
+# Most CPUs a single srun job step may ask for within the allocation
+SRUN_MAX_CPUS = min(int(os.environ.get("SLURM_CPUS_PER_TASK") or AVAILABLE_CPUS), AVAILABLE_CPUS)
+
+# Seconds between sacct checks while waiting for a SLURM array job to finish
+SLURM_POLL_SECONDS = 10
+
+# Consecutive failed sacct checks after which an array job is given up on, e.g. when
+# SLURM accounting is disabled and sacct can never report the job's state
+SLURM_POLL_MAX_FAILURES = 6
+
+# SLURM job states meaning an array task is no longer pending or running
+SLURM_FINISHED_STATES = {
+    "COMPLETED", "FAILED", "CANCELLED", "TIMEOUT", "OUT_OF_MEMORY",
+    "NODE_FAIL", "PREEMPTED", "BOOT_FAIL", "DEADLINE",
+}
 
 def display_logo():
     """Display the GRIGSBY QIIME2 SCRIPT ASCII art logo"""
@@ -54,6 +135,13 @@ def display_logo():
 
 def fly_message(message, type="info"):
     """Display a message with emoji indicators, fly emoji only for step headers"""
+    if not INTERACTIVE:
+        print(PLAIN_MESSAGE_FORMATS[type].format(message))
+        # Progress messages wait in the stdout buffer, but problems should show up in the log straight away
+        if type in ("warning", "error"):
+            sys.stdout.flush()
+        return
+    
     # Only show the fly emoji for step headers (messages that start with '=====')
     has_fly = message.startswith("\n=====")
     
@@ -71,49 +159,607 @@ def fly_message(message, type="info"):
         print(f"❓ {message}")
     elif type == "skip":
         print(f"⏩ SKIPPING: {message} (files already exist)")
-    sys.stdout.flush()  # Ensure message is displayed immediately
+
+# Cached directory listings used by exists(), keyed by directory path
+_dir_cache = {}
+
+def exists(path):
+    """Check if a path exists using a cached listing of its parent directory"""
+    directory, name = os.path.split(path)
+    directory = directory or "."
+    if directory not in _dir_cache:
+        _dir_cache[directory] = {entry.name for entry in os.scandir(directory)} if os.path.isdir(directory) else set()
+    return name in _dir_cache[directory]
 
 def check_output_exists(files):
     """Check if all output files already exist"""
     if isinstance(files, str):
         files = [files]
-    return all(os.path.exists(f) for f in files)
+    return all(exists(f) for f in files)
+
+# Record of completed steps, so a rerun only skips steps whose command and inputs are unchanged
+STATE_CACHE = ".qiime_cache.json"
+_state_cache = None
+
+# Flags whose value is a thread count, which doesn't affect a step's outputs
+THREAD_FLAGS = {"--p-n-threads", "--p-cores", "--p-n-jobs", "--p-n-jobs-or-threads"}
+
+# Serializes writes from the spinner thread with messages printed while a batch is running
+_output_lock = threading.Lock()
+
+def _load_state_cache():
+    """Load the record of completed steps, mapping each step's key to its outputs"""
+    global _state_cache
+    if _state_cache is None:
+        try:
+            with open(STATE_CACHE) as f:
+                _state_cache = json.load(f)
+        except (FileNotFoundError, ValueError):
+            _state_cache = {}
+    return _state_cache
+
+def step_key(step):
+    """Hash a step's command together with the size and modification time of each of its inputs
+    (and of each entry in inputs that are directories)
+
+    Thread count flags are left out, since changing --threads doesn't change the results.
+    """
+    if callable(step.command):
+        # Describe in-process steps by function and arguments, which stay the same across runs
+        command = [step.command.func.__name__, *map(str, step.command.args)]
+    else:
+        command = [arg for i, arg in enumerate(step.command) if arg not in THREAD_FLAGS and step.command[i - 1] not in THREAD_FLAGS]
+    signatures = []
+    for path in step.inputs:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            signatures.append(f"{path}:missing")
+            continue
+        signatures.append(f"{path}:{st.st_mtime_ns}:{st.st_size}")
+        if stat.S_ISDIR(st.st_mode):
+            # Overwriting a file in a directory doesn't change the directory's own mtime,
+            # so include every entry in it
+            with os.scandir(path) as entries:
+                for entry in sorted(entries, key=lambda entry: entry.name):
+                    entry_st = entry.stat()
+                    signatures.append(f"{entry.path}:{entry_st.st_mtime_ns}:{entry_st.st_size}")
+    return hashlib.sha256((" ".join(command) + "|" + "|".join(signatures)).encode()).hexdigest()
+
+def is_up_to_date(step):
+    """Check if a step's outputs exist and were made by the same command from the same inputs"""
+    if not check_output_exists(step.outputs):
+        return False
+    state_cache = _load_state_cache()
+    if step_key(step) in state_cache:
+        return True
+    # Outputs made before there was a record of them (e.g. by an older version of this
+    # script) are trusted as long as no record says they came from something else
+    return not any(set(outputs) & set(step.outputs) for outputs in state_cache.values())
+
+def record_step(step):
+    """Record that a step has just produced its outputs from its current inputs"""
+    state_cache = _load_state_cache()
+    for key in [key for key, outputs in state_cache.items() if set(outputs) & set(step.outputs)]:
+        del state_cache[key]
+    state_cache[step_key(step)] = step.outputs
+    # Write the whole record to a temporary file and swap it in, so a crash can't leave it half written
+    with open(f"{STATE_CACHE}.tmp", "w") as f:
+        json.dump(state_cache, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f"{STATE_CACHE}.tmp", STATE_CACHE)
 
 def spinner_animation(stop_event, description):
     """Display an animated spinner while a command is running"""
-    spinner = itertools.cycle(['⠋', '⠙', '⠹', '⠸', '⠼', '⠴', '⠦', '⠧', '⠇', '⠏'])
+    # Don't animate when the output is redirected to a file or pipe
+    if not INTERACTIVE:
+        stop_event.wait()
+        return
+    frames = [f"\r🪰 Running: {description}... {c} " for c in "⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏"]
+    i = 0
     while not stop_event.is_set():
-        sys.stdout.write(f"\r🪰 Running: {description}... {next(spinner)} ")
-        sys.stdout.flush()
-        time.sleep(0.1)
+        with _output_lock:
+            sys.stdout.write(frames[i % len(frames)])
+            sys.stdout.flush()
+        i += 1
+        # Waiting on the event rather than sleeping lets the spinner stop as soon as the command is done
+        stop_event.wait(0.1)
     # Clear the spinner line when done
     sys.stdout.write(f"\r{' ' * (len(description) + 20)}\r")
     sys.stdout.flush()
 
-def run_command(command, description):
-    """Run a command with error handling and animated spinner"""
-    fly_message(f"Running: {description}...", "running")
+@dataclass
+class Step:
+    """A command to run, with the files it reads and writes
+
+    The command is either an argv list to run as a subprocess, or a Python
+    callable taking no arguments that is run in-process on a worker thread.
+    """
+    description: str
+    command: object
+    inputs: list = field(default_factory=list)
+    outputs: list = field(default_factory=list)
+    # Whether to note the step in the record of completed steps when it succeeds
+    record: bool = True
+
+def build_command(command, description, inputs=(), outputs=()):
+    """Build a step so it can be run on its own or as part of a batch"""
+    return Step(description, command, list(inputs), list(outputs))
+
+def stage_step(step, root, scratch_dir, staged_outputs):
+    """Copy a step so the files it writes under root go under scratch_dir instead
+
+    Inputs under root are read from scratch_dir only if they are in staged_outputs,
+    i.e. written by a step staged before this one. The copy isn't noted in the record
+    of completed steps, since its paths differ from run to run.
+    """
+    kept_inputs = {path for path in step.inputs if path not in staged_outputs}
+    
+    def stage(arg):
+        if isinstance(arg, list):
+            return [stage(item) for item in arg]
+        if isinstance(arg, str) and (arg == root or arg.startswith(f"{root}/")) and arg not in kept_inputs:
+            return os.path.join(scratch_dir, arg)
+        return arg
+    
+    if callable(step.command):
+        command = functools.partial(step.command.func, *map(stage, step.command.args))
+    else:
+        command = stage(step.command)
+    return Step(step.description, command, stage(step.inputs), stage(step.outputs), record=False)
+
+def _step_cpus(command):
+    """Count the CPUs a command uses: the value of its thread count flag, or one if it has none"""
+    for flag, value in zip(command, command[1:]):
+        if flag in THREAD_FLAGS and value.isdigit():
+            # srun refuses a step asking for more CPUs than the allocation has
+            return max(1, min(int(value), SRUN_MAX_CPUS))
+    return 1
+
+async def _run_job(job, semaphore):
+    """Run a single step once a worker slot is free, returning its exit code and error details"""
+    async with semaphore:
+        if callable(job.command):
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, job.command)
+            except Exception as e:
+                return None, f"{type(e).__name__}: {e}"
+            return 0, ""
+        command = job.command
+        if SRUN:
+            command = [SRUN, "--exclusive", "-n1", f"-c{_step_cpus(command)}", *command]
+        try:
+            # Exec the argv list directly rather than through /bin/sh, and discard stdout
+            process = await asyncio.create_subprocess_exec(
+                *command, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+            )
+        except OSError as e:
+            return None, str(e)
+        # Drain stderr in large blocks as it is written so the child never blocks on a full
+        # pipe, keeping only the last lines rather than buffering all of it
+        stderr_tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+        partial_line = b""
+        while True:
+            block = await process.stderr.read(STDERR_READ_SIZE)
+            if not block:
+                break
+            lines = (partial_line + block).split(b"\n")
+            # Progress bars can write for a long time without a newline, so cap the unfinished line
+            partial_line = lines.pop()[-STDERR_READ_SIZE:]
+            stderr_tail.extend(lines)
+        if partial_line:
+            stderr_tail.append(partial_line)
+        await process.wait()
+        return process.returncode, "\n".join(line.decode(errors="replace") for line in stderr_tail)
+
+def _report(message, type, clear_width):
+    """Print a message over the spinner line while a batch is running"""
+    with _output_lock:
+        if INTERACTIVE:
+            sys.stdout.write(f"\r{' ' * clear_width}\r")
+        fly_message(message, type)
+
+def _report_result(job, returncode, details, clear_width):
+    """Report whether a finished step succeeded, returning True if it did"""
+    if returncode == 0:
+        _report(f"Successfully completed: {job.description}", "success", clear_width)
+    elif callable(job.command):
+        _report(f"ERROR: Task failed: {job.description}", "error", clear_width)
+        _report(f"ERROR: Error details: {details}", "error", clear_width)
+    else:
+        _report(f"ERROR: Command failed: {' '.join(job.command)}", "error", clear_width)
+        _report(f"ERROR: Error details: {details}", "error", clear_width)
+    # Write the result out now rather than when the batch ends, which for steps 5-18 can be hours later
+    with _output_lock:
+        sys.stdout.flush()
+    return returncode == 0
+
+def _flush_and_terminate(signum, frame):
+    """Write out buffered messages, then let the signal terminate the script as usual"""
+    # The signal may arrive in the middle of a write to stdout, which a flush can't re-enter
+    with contextlib.suppress(RuntimeError, OSError):
+        sys.stdout.flush()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+async def _run_jobs(jobs, max_workers, clear_width):
+    """Run steps as soon as the steps producing their inputs have succeeded
+
+    At most max_workers steps run at once. A step whose inputs come from a
+    step that failed is not run, and counts as failed itself.
+    """
+    semaphore = asyncio.Semaphore(max_workers)
+    tasks = []
+    
+    async def run(job, dependencies):
+        if not all(await asyncio.gather(*dependencies)):
+            _report(f"Not running {job.description} because a step it depends on failed", "warning", clear_width)
+            return False
+        _report(f"Running: {job.description}...", "running", clear_width)
+        returncode, stderr = await _run_job(job, semaphore)
+        succeeded = _report_result(job, returncode, stderr, clear_width)
+        if succeeded and job.record:
+            record_step(job)
+        return succeeded
+    
+    # Steps only wait on earlier steps in the list, so the graph can't contain a cycle
+    producers = {}
+    for job in jobs:
+        dependencies = {producers[path] for path in job.inputs if path in producers}
+        task = asyncio.ensure_future(run(job, dependencies))
+        for path in job.outputs:
+            producers[path] = task
+        tasks.append(task)
+    return await asyncio.gather(*tasks)
+
+def _run_slurm_array(jobs, max_workers):
+    """Append commands to the batch manifest, run them as one SLURM array job and wait for it
+
+    Returns an (exit code, error details) pair for each job, like _run_job.
+    """
+    manifest = os.path.abspath(BATCH_MANIFEST)
+    with open(manifest, "a+") as f:
+        f.seek(0)
+        # Line number of this array's first command; array task IDs count from 0 within each
+        # array so they stay below SLURM's MaxArraySize however many arrays a run submits
+        offset = sum(1 for _ in f)
+        for job in jobs:
+            f.write(json.dumps({
+                "name": job.description,
+                "cmd": " ".join(shlex.quote(arg) for arg in job.command),
+                "outputs": job.outputs,
+            }) + "\n")
+    log_dir = os.path.dirname(manifest)
+    
+    # Each array task runs the command on the manifest line matching its task ID
+    script = f"""#!/bin/bash
+#SBATCH --job-name=qiime-time
+#SBATCH --array=0-{len(jobs) - 1}%{max_workers}
+#SBATCH --cpus-per-task={BATCH_CPUS_PER_TASK}
+cmd=$(sed -n "$((SLURM_ARRAY_TASK_ID + {offset + 1}))p" {shlex.quote(manifest)} | {shlex.quote(sys.executable)} -c 'import json, sys; print(json.load(sys.stdin)["cmd"])')
+exec bash -c "$cmd"
+"""
+    try:
+        # The log path goes on the command line, where a directory name with spaces needs no quoting
+        submitted = subprocess.run(["sbatch", "--parsable", f"--output={log_dir}/slurm-%A_%a.out"], input=script, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    except OSError as e:
+        return [(None, f"Could not submit SLURM job: {e}")] * len(jobs)
+    if submitted.returncode != 0:
+        return [(None, f"Could not submit SLURM job: {submitted.stderr}")] * len(jobs)
+    job_id = submitted.stdout.strip().split(";")[0]
+    
+    # Poll accounting until every array task has finished
+    states = {}
+    failures = 0
+    while len(states) < len(jobs) or not all(state in SLURM_FINISHED_STATES for state in states.values()):
+        time.sleep(SLURM_POLL_SECONDS)
+        try:
+            accounting = subprocess.run(
+                ["sacct", "-j", job_id, "-n", "-P", "-X", "-o", "JobID,State"],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+            )
+        except OSError as e:
+            accounting = subprocess.CompletedProcess([], 1, "", str(e))
+        if accounting.returncode != 0:
+            failures += 1
+            if failures >= SLURM_POLL_MAX_FAILURES:
+                # Without a way to tell when the tasks finish, cancel them rather than leave them
+                # writing outputs behind the steps that are about to be reported as failed
+                with contextlib.suppress(OSError):
+                    subprocess.run(["scancel", job_id], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                return [(None, f"Could not check SLURM job {job_id} with sacct, so it was cancelled: {accounting.stderr.strip()}")] * len(jobs)
+            continue
+        failures = 0
+        for line in accounting.stdout.splitlines():
+            task_id, _, state = line.partition("|")
+            _, _, index = task_id.partition("_")
+            # Tasks that haven't started yet are listed as a range, e.g. 123_[4-7%2]
+            if index.isdigit() and state:
+                states[int(index)] = state.split()[0]
+    
+    results = []
+    for index in range(len(jobs)):
+        if states[index] == "COMPLETED":
+            results.append((0, ""))
+            continue
+        details = f"SLURM task {job_id}_{index} ended in state {states[index]}"
+        log_path = f"{log_dir}/slurm-{job_id}_{index}.out"
+        if os.path.exists(log_path):
+            with open(log_path, errors="replace") as log:
+                details += "\n" + "".join(collections.deque(log, maxlen=STDERR_TAIL_LINES))
+        results.append((None, details))
+    return results
+
+def _run_jobs_on_slurm(jobs, max_workers, clear_width):
+    """Run steps on SLURM, submitting each wave of steps whose inputs are ready as one array job
+
+    Python callables can't be sent to SLURM, so they are run locally on worker
+    threads while the array runs. A step whose inputs come from a step that
+    failed is not run.
+    """
+    producers = {}
+    dependencies = []
+    for i, job in enumerate(jobs):
+        dependencies.append({producers[path] for path in job.inputs if path in producers})
+        for path in job.outputs:
+            producers[path] = i
+    
+    results = [None] * len(jobs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        while None in results:
+            wave = [i for i, result in enumerate(results) if result is None and all(results[d] is not None for d in dependencies[i])]
+            commands = []
+            calls = {}
+            for i in wave:
+                job = jobs[i]
+                if not all(results[d] for d in dependencies[i]):
+                    _report(f"Not running {job.description} because a step it depends on failed", "warning", clear_width)
+                    results[i] = False
+                elif callable(job.command):
+                    _report(f"Running: {job.description}...", "running", clear_width)
+                    calls[i] = executor.submit(job.command)
+                else:
+                    _report(f"Submitting to SLURM: {job.description}...", "running", clear_width)
+                    commands.append(i)
+            if commands:
+                outcomes = _run_slurm_array([jobs[i] for i in commands], max_workers)
+                for i, (returncode, details) in zip(commands, outcomes):
+                    results[i] = _report_result(jobs[i], returncode, details, clear_width)
+            for i, call in calls.items():
+                try:
+                    call.result()
+                    results[i] = _report_result(jobs[i], 0, "", clear_width)
+                except Exception as e:
+                    results[i] = _report_result(jobs[i], None, f"{type(e).__name__}: {e}", clear_width)
+            for i in wave:
+                if results[i] and jobs[i].record:
+                    record_step(jobs[i])
+    return results
+
+def start_plan_script(path):
+    """Start a new plan script that batches of commands are appended to"""
+    with open(path, "w") as f:
+        f.write("#!/usr/bin/env bash\nset -euo pipefail\npids=()\n")
+    os.chmod(path, 0o755)
+
+def add_to_plan(description, *commands):
+    """Write commands that the script carries out itself, rather than through run_batch, to the plan script"""
+    if PLAN_SCRIPT:
+        with open(PLAN_SCRIPT, "a") as f:
+            f.write(f"\n# {description}\n" + "".join(f"{shlex.join(command)}\n" for command in commands))
+
+def _biom_to_tsv_commands(biom_path, tsv_paths):
+    """Return the commands that convert a biom table to the given TSV files from the command line"""
+    plain_path = tsv_paths[0].removesuffix(".gz")
+    commands = [["biom", "convert", "-i", biom_path, "-o", plain_path, "--to-tsv"]]
+    if f"{plain_path}.gz" in tsv_paths:
+        # Keep the plain TSV only if it was asked for too
+        commands.append(["gzip", "-1", "-f", *(["-k"] if plain_path in tsv_paths else []), plain_path])
+    return commands
+
+def _shell_commands(job):
+    """Return the commands that do the same as a step from the command line
+
+    In-process exports are written as the QIIME2 and biom CLI commands they
+    stand in for. Returns an empty list for any other in-process step.
+    """
+    if not callable(job.command):
+        return [job.command]
+    func, args = job.command.func, job.command.args
+    if func is export_artifact:
+        input_path, output_dir = args
+        return [["qiime", "tools", "export", "--input-path", input_path, "--output-path", output_dir]]
+    if func is export_feature_table:
+        input_path, biom_path, tsv_paths = args
+        output_dir = os.path.dirname(tsv_paths[0])
+        commands = [
+            ["qiime", "tools", "export", "--input-path", input_path, "--output-path", output_dir],
+            *_biom_to_tsv_commands(f"{output_dir}/feature-table.biom", tsv_paths),
+        ]
+        if not biom_path:
+            commands.append(["rm", "-f", f"{output_dir}/feature-table.biom"])
+        return commands
+    if func is convert_biom_to_tsv:
+        return _biom_to_tsv_commands(*args)
+    return []
+
+def _append_to_plan(jobs):
+    """Append a batch of steps to the plan script, in waves of steps that can run in parallel
+
+    Each wave's commands are started in the background and waited for before
+    the next wave starts, so a step runs after the steps producing its inputs.
+    """
+    producers = {}
+    levels = []
+    for i, job in enumerate(jobs):
+        levels.append(max((levels[producers[path]] + 1 for path in job.inputs if path in producers), default=0))
+        for path in job.outputs:
+            producers[path] = i
     
-    # Set up and start the spinner in a separate thread
+    with open(PLAN_SCRIPT, "a") as f:
+        for level in range(max(levels) + 1):
+            wave = [(job, _shell_commands(job)) for job, job_level in zip(jobs, levels) if job_level == level]
+            parallel = sum(bool(commands) for _, commands in wave) > 1
+            f.write("\n")
+            for job, commands in wave:
+                if not commands:
+                    f.write(f"# Run in-process by the pipeline script: {job.description}\n")
+                elif parallel:
+                    script = " && ".join(shlex.join(command) for command in commands)
+                    # A step made of several commands runs them in order in one background subshell
+                    background = script if len(commands) == 1 else f"({script})"
+                    f.write(f"# {job.description}\n{background} &\npids+=($!)\n")
+                else:
+                    f.write(f"# {job.description}\n" + "".join(f"{shlex.join(command)}\n" for command in commands))
+            if parallel:
+                # Wait on each command by its PID so that a failure stops the script
+                f.write('for pid in "${pids[@]}"; do wait "$pid"; done\npids=()\n')
+
+def run_batch(jobs, max_workers=AVAILABLE_CPUS, plan_jobs=None):
+    """Run steps concurrently with error handling and animated spinner
+
+    Steps must be listed after the steps producing their inputs; each one starts
+    as soon as those have finished. Returns a list with True/False for each
+    step, in the same order as the steps were given. With --emit-plan, plan_jobs
+    (by default the steps themselves) are written to the plan script.
+    """
+    if not jobs:
+        return []
+    
+    if PLAN_SCRIPT:
+        _append_to_plan(plan_jobs or jobs)
+    
+    # Write out any buffered messages before the commands start, so a redirected log is current while they run
+    sys.stdout.flush()
+    
+    # Set up and start a single spinner for the whole batch in a separate thread
+    spinner_description = jobs[0].description if len(jobs) == 1 else f"{len(jobs)} tasks"
     stop_spinner = threading.Event()
-    spinner_thread = threading.Thread(target=spinner_animation, args=(stop_spinner, description))
+    spinner_thread = threading.Thread(target=spinner_animation, args=(stop_spinner, spinner_description))
     spinner_thread.daemon = True
     spinner_thread.start()
     
     try:
-        result = subprocess.run(command, shell=True, check=True, stderr=subprocess.PIPE, text=True)
+        if BATCH_MANIFEST:
+            return _run_jobs_on_slurm(jobs, max_workers or 1, len(spinner_description) + 20)
+        return asyncio.run(_run_jobs(jobs, max_workers or 1, len(spinner_description) + 20))
+    finally:
         # Stop the spinner
         stop_spinner.set()
         spinner_thread.join()
-        fly_message(f"Successfully completed: {description}", "success")
-        return True
-    except subprocess.CalledProcessError as e:
-        # Stop the spinner
-        stop_spinner.set()
-        spinner_thread.join()
-        fly_message(f"ERROR: Command failed: {e.cmd}", "error")
-        fly_message(f"ERROR: Error details: {e.stderr}", "error")
+        # The commands may have written new files, so cached directory listings are stale
+        _dir_cache.clear()
+
+def run_step(step):
+    """Run a single step with error handling and animated spinner"""
+    return run_batch([step])[0]
+
+def run_command(command, description, inputs=(), outputs=()):
+    """Run a command with error handling and animated spinner"""
+    return run_step(build_command(command, description, inputs, outputs))
+
+class ArtifactCache:
+    """Load each QIIME2 artifact once and hand the same object to every caller
+
+    Loading an artifact unzips it and parses its provenance, so steps that use
+    the same .qza share one loaded copy. Safe to use from several threads.
+    """
+    def __init__(self):
+        self._artifacts = {}
+        self._locks = collections.defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+    
+    def get(self, path):
+        """Return the loaded artifact for path, loading it on first use"""
+        with self._lock:
+            path_lock = self._locks[path]
+        # Different artifacts can load in parallel, but each one is only loaded once
+        with path_lock:
+            if path not in self._artifacts:
+                from qiime2 import Artifact
+                self._artifacts[path] = Artifact.load(path)
+            return self._artifacts[path]
+
+_artifact_cache = ArtifactCache()
+
+def export_artifact(input_path, output_dir):
+    """Export a QIIME2 artifact in-process, equivalent to `qiime tools export`"""
+    _artifact_cache.get(input_path).export_data(output_dir)
+
+class TeeWriter:
+    """File-like object that copies every write to several open files"""
+    
+    def __init__(self, files):
+        self.files = files
+    
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+    
+    def writelines(self, lines):
+        # biom writes the table header with writelines() and the rows with write()
+        for line in lines:
+            self.write(line)
+
+def write_table_tsv(table, tsv_paths):
+    """Write a biom table as TSV to each path, gzip-compressed where the path ends in .gz
+
+    The rows are formatted once and copied to every file, and each file is
+    written under a temporary name and renamed into place, so a failed write
+    never looks like a finished one on rerun.
+    """
+    try:
+        with contextlib.ExitStack() as stack:
+            files = []
+            for tsv_path in tsv_paths:
+                if tsv_path.endswith(".gz"):
+                    # The fastest compression level still shrinks count tables several times over
+                    files.append(stack.enter_context(gzip.open(f"{tsv_path}.tmp", "wt", compresslevel=1)))
+                else:
+                    files.append(stack.enter_context(open(f"{tsv_path}.tmp", "w", buffering=1 << 20)))
+            # Stream each row into the files as it is formatted instead of building the whole TSV as one string.
+            # Streamed rows each end in a newline, so unlike `biom convert --to-tsv` the file ends with one.
+            table.to_tsv(direct_io=files[0] if len(files) == 1 else TeeWriter(files))
+    except BaseException:
+        # Don't leave partly written files behind
+        for tsv_path in tsv_paths:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(f"{tsv_path}.tmp")
+        raise
+    for tsv_path in tsv_paths:
+        os.replace(f"{tsv_path}.tmp", tsv_path)
+
+def export_feature_table(input_path, biom_path, tsv_paths):
+    """Export a feature table artifact in-process to both biom (HDF5) and TSV from one load
+
+    The biom file is left out if biom_path is None.
+    """
+    import biom
+    from biom.util import biom_open
+    table = _artifact_cache.get(input_path).view(biom.Table)
+    os.makedirs(os.path.dirname(tsv_paths[0]), exist_ok=True)
+    if biom_path:
+        # Write to a temporary file first so a failed export never looks like a finished one on rerun
+        with biom_open(f"{biom_path}.tmp", "w") as f:
+            table.to_hdf5(f, "qiime-time")
+        os.replace(f"{biom_path}.tmp", biom_path)
+    write_table_tsv(table, tsv_paths)
+
+def convert_biom_to_tsv(biom_path, tsv_paths):
+    """Convert a biom table to TSV in-process, like `biom convert --to-tsv` but with a trailing newline"""
+    from biom import load_table
+    write_table_tsv(load_table(biom_path), tsv_paths)
+
+def remove_intermediate_biom(biom_path, tsv_paths):
+    """Delete an exported biom file once the TSVs made from it are written, returning True if it was deleted"""
+    if not all(os.path.isfile(tsv_path) and os.path.getsize(tsv_path) > 0 for tsv_path in tsv_paths):
+        return False
+    try:
+        os.unlink(biom_path)
+    except FileNotFoundError:
         return False
+    return True
 
 def open_qzv_file(file_path):
     """Open the default QIIME2 View site for manual file loading"""
@@ -131,31 +777,109 @@ def open_qzv_file(file_path):
     else:
         fly_message(f"Could not find {file_path} to open", "warning")
 
+def file_kind(path):
+    """Return 'd' for a directory, 'f' for any other file, or None if path doesn't exist, using a single stat"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return "d" if stat.S_ISDIR(st.st_mode) else "f"
+
 def check_prerequisites():
     """Check if all required files and directories exist"""
     fly_message("Checking for required files and directories...", "info")
     
     # Check for paired-end-demultiplexed directory
-    if not os.path.isdir("paired-end-demultiplexed"):
+    if file_kind("paired-end-demultiplexed") != "d":
         fly_message("Missing 'paired-end-demultiplexed' directory with FASTQ files!", "error")
         return False
     
     # Check for metadata.tsv
-    if not os.path.isfile("metadata.tsv"):
+    if file_kind("metadata.tsv") != "f":
         fly_message("Missing 'metadata.tsv' file!", "error")
         return False
     
     # Check for classifier.qza
-    if not os.path.isfile("classifier.qza"):
+    if file_kind("classifier.qza") != "f":
         fly_message("Missing 'classifier.qza' file!", "error")
         return False
     
     fly_message("All required files are present!", "success")
     return True
 
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Interactive QIIME2 analysis pipeline")
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=NTHREADS,
+        help=f"Number of threads/jobs for DADA2, cutadapt, MAFFT, FastTree, classify-sklearn and core metrics (default: {NTHREADS})"
+    )
+    parser.add_argument(
+        "--no-srun",
+        action="store_true",
+        help="Run commands directly even inside a SLURM allocation, rather than as srun job steps"
+    )
+    parser.add_argument(
+        "--batch-manifest",
+        metavar="PATH",
+        help="Submit commands to SLURM as job arrays, recording each command as a JSON line in PATH"
+    )
+    parser.add_argument(
+        "--tsv-format",
+        choices=["plain", "gzip", "both"],
+        default="plain",
+        help="Write the exported feature table TSVs plain (.tsv), gzip-compressed (.tsv.gz) or both from one pass over each table (default: plain)"
+    )
+    parser.add_argument(
+        "--prune-intermediates",
+        action="store_true",
+        help="Don't keep the exported feature table biom files once their TSVs have been written"
+    )
+    parser.add_argument(
+        "--scratch-dir",
+        metavar="DIR",
+        help="Write the exports under DIR (e.g. node-local $TMPDIR) and copy them into 'exports' once they are all done"
+    )
+    parser.add_argument(
+        "--emit-plan",
+        metavar="PATH",
+        help="Also write every command that is run to a bash script at PATH, with independent commands run in parallel"
+    )
+    return parser.parse_args()
+
 def main():
     """Main function to run the QIIME2 workflow"""
-    display_logo()
+    global BATCH_MANIFEST, BATCH_CPUS_PER_TASK, PLAN_SCRIPT, SRUN
+    args = parse_args()
+    threads = str(args.threads)
+    if args.no_srun:
+        SRUN = None
+    if args.scratch_dir and not (os.path.isdir(args.scratch_dir) and os.access(args.scratch_dir, os.W_OK | os.X_OK)):
+        fly_message(f"The scratch directory '{args.scratch_dir}' doesn't exist or isn't writable", "error")
+        return
+    BATCH_MANIFEST = args.batch_manifest
+    if BATCH_MANIFEST:
+        # Each run starts a new manifest listing just the commands it submits
+        open(BATCH_MANIFEST, "w").close()
+    PLAN_SCRIPT = args.emit_plan
+    if PLAN_SCRIPT:
+        start_plan_script(PLAN_SCRIPT)
+    BATCH_CPUS_PER_TASK = threads
+    
+    if INTERACTIVE:
+        display_logo()
+    else:
+        # Give redirected output a larger buffer than Python's default, so messages are written in fewer, bigger blocks
+        sys.stdout.flush()
+        sys.stdout = io.TextIOWrapper(
+            open(sys.stdout.fileno(), "wb", buffering=LOG_BUFFER_SIZE, closefd=False),
+            encoding=sys.stdout.encoding,
+            errors=sys.stdout.errors,
+        )
+        # SLURM sends SIGTERM at the time limit, which would otherwise drop whatever is still buffered
+        signal.signal(signal.SIGTERM, _flush_and_terminate)
     
     fly_message("This script will guide you through a complete QIIME2 analysis workflow", "info")
     
@@ -169,34 +893,50 @@ def main():
         fly_message("Please add the missing files and run the script again", "error")
         return
     
+    # Outputs rewritten during this run, so steps reading them must run again too
+    stale_outputs = set()
+    
     # Step 1: Import sequences
     fly_message("\n===== STEP 1: IMPORTING SEQUENCES =====", "info")
-    if check_output_exists("demux-paired-end.qza"):
+    import_step = build_command(
+        [
+            "qiime", "tools", "import",
+            "--type", "SampleData[PairedEndSequencesWithQuality]",
+            "--input-path", "paired-end-demultiplexed",
+            "--input-format", "CasavaOneEightSingleLanePerSampleDirFmt",
+            "--output-path", "demux-paired-end.qza",
+        ],
+        "Sequence import",
+        inputs=["paired-end-demultiplexed"],
+        outputs=["demux-paired-end.qza"]
+    )
+    if stale_outputs.isdisjoint(import_step.inputs) and is_up_to_date(import_step):
         fly_message("Sequence import", "skip")
-    elif not run_command(
-        "qiime tools import \
-        --type 'SampleData[PairedEndSequencesWithQuality]' \
-        --input-path paired-end-demultiplexed \
-        --input-format CasavaOneEightSingleLanePerSampleDirFmt \
-        --output-path demux-paired-end.qza",
-        "Sequence import"
-    ):
+    elif not run_step(import_step):
         fly_message("Failed to import sequences. Exiting...", "error")
         return
+    else:
+        stale_outputs.update(import_step.outputs)
     
     # Step 2: Summarize demultiplexed data
     fly_message("\n===== STEP 2: SUMMARIZING DEMULTIPLEXED DATA =====", "info")
-    if check_output_exists("demux-paired-end-summ.qzv"):
+    summarize_step = build_command(
+        [
+            "qiime", "demux", "summarize",
+            "--i-data", "demux-paired-end.qza",
+            "--o-visualization", "demux-paired-end-summ.qzv",
+        ],
+        "Demux summarization",
+        inputs=["demux-paired-end.qza"],
+        outputs=["demux-paired-end-summ.qzv"]
+    )
+    if stale_outputs.isdisjoint(summarize_step.inputs) and is_up_to_date(summarize_step):
         fly_message("Demultiplexed data summarization", "skip")
-    elif not run_command(
-        "qiime demux summarize \
-        --i-data demux-paired-end.qza \
-        --o-visualization demux-paired-end-summ.qzv",
-        "Demux summarization"
-    ):
+    elif not run_step(summarize_step):
         fly_message("Failed to summarize demultiplexed data. Exiting...", "error")
         return
     else:
+        stale_outputs.update(summarize_step.outputs)
         open_qzv_file("demux-paired-end-summ.qzv")
     
     # Prompt to examine quality plots
@@ -220,18 +960,26 @@ def main():
         reverse_primer = "GACTACHVGGGTATCTAATCC"  # Default V3-V4 region reverse primer
         fly_message("Using default V3-V4 region primers", "info")
     
-    if check_output_exists("trim-seqs.qza"):
+    trim_step = build_command(
+        [
+            "qiime", "cutadapt", "trim-paired",
+            "--i-demultiplexed-sequences", "demux-paired-end.qza",
+            "--p-front-f", forward_primer,
+            "--p-front-r", reverse_primer,
+            "--p-cores", threads,
+            "--o-trimmed-sequences", "trim-seqs.qza",
+        ],
+        "Adapter trimming",
+        inputs=["demux-paired-end.qza"],
+        outputs=["trim-seqs.qza"]
+    )
+    if stale_outputs.isdisjoint(trim_step.inputs) and is_up_to_date(trim_step):
         fly_message("Adapter trimming", "skip")
-    elif not run_command(
-        f"qiime cutadapt trim-paired \
-        --i-demultiplexed-sequences demux-paired-end.qza \
-        --p-front-f {forward_primer} \
-        --p-front-r {reverse_primer} \
-        --o-trimmed-sequences trim-seqs.qza",
-        "Adapter trimming"
-    ):
+    elif not run_step(trim_step):
         fly_message("Failed to trim adapters. Exiting...", "error")
         return
+    else:
+        stale_outputs.update(trim_step.outputs)
     
     # Step 4: DADA2 denoising
     fly_message("\n===== STEP 4: DADA2 DENOISING =====", "info")
@@ -258,269 +1006,341 @@ def main():
         fly_message("Using default truncation parameters", "info")
     
     fly_message("This step may take a while... Time to stretch your wings!", "info")
-    # Check if DADA2 outputs already exist
-    if check_output_exists(["dada-table.qza", "dada-rep-seqs.qza", "dada-denoising-stats.qza"]):
+    # Use the QIIME2 CLI command for DADA2 with customizable parameters
+    dada2_step = build_command(
+        [
+            "qiime", "dada2", "denoise-paired",
+            "--i-demultiplexed-seqs", "trim-seqs.qza",
+            "--p-trim-left-f", trim_left_f,
+            "--p-trim-left-r", trim_left_r,
+            "--p-trunc-len-f", trunc_len_f,
+            "--p-trunc-len-r", trunc_len_r,
+            "--p-n-threads", threads,
+            "--o-table", "dada-table.qza",
+            "--o-representative-sequences", "dada-rep-seqs.qza",
+            "--o-denoising-stats", "dada-denoising-stats.qza",
+        ],
+        "DADA2 denoising",
+        inputs=["trim-seqs.qza"],
+        outputs=["dada-table.qza", "dada-rep-seqs.qza", "dada-denoising-stats.qza"]
+    )
+    # Check if DADA2 outputs already exist and were made with the same parameters
+    if stale_outputs.isdisjoint(dada2_step.inputs) and is_up_to_date(dada2_step):
         fly_message("DADA2 denoising", "skip")
-    else:
-        # Use the QIIME2 CLI command for DADA2 with customizable parameters
-        if not run_command(
-            f"qiime dada2 denoise-paired \
-            --i-demultiplexed-seqs trim-seqs.qza \
-            --p-trim-left-f {trim_left_f} \
-            --p-trim-left-r {trim_left_r} \
-            --p-trunc-len-f {trunc_len_f} \
-            --p-trunc-len-r {trunc_len_r} \
-            --o-table dada-table.qza \
-            --o-representative-sequences dada-rep-seqs.qza \
-            --o-denoising-stats dada-denoising-stats.qza",
-            "DADA2 denoising"
-        ):
-            fly_message("Failed to denoise sequences. Exiting...", "error")
-            return
-    
-    # Step 5: View denoising stats
-    fly_message("\n===== STEP 5: VIEWING DENOISING STATISTICS =====", "info")
-    if check_output_exists("dada-denoising-stats-summ.qzv"):
-        fly_message("Denoising stats tabulation", "skip")
-        if input("🪰❓ Would you like to view the denoising stats? (yes/no): ").strip().lower() in ["yes", "y"]:
-            open_qzv_file("dada-denoising-stats-summ.qzv")
-    elif not run_command(
-        "qiime metadata tabulate \
-        --m-input-file dada-denoising-stats.qza \
-        --o-visualization dada-denoising-stats-summ.qzv",
-        "Denoising stats tabulation"
-    ):
-        fly_message("Failed to tabulate denoising stats. Continuing anyway...", "warning")
-    else:
-        open_qzv_file("dada-denoising-stats-summ.qzv")
-    
-    # Step 6: Tabulate representative sequences
-    fly_message("\n===== STEP 6: TABULATING REPRESENTATIVE SEQUENCES =====", "info")
-    if check_output_exists("dada-rep-seqs-summ.qzv"):
-        fly_message("Representative sequences tabulation", "skip")
-        if input("🪰❓ Would you like to view the representative sequences? (yes/no): ").strip().lower() in ["yes", "y"]:
-            open_qzv_file("dada-rep-seqs-summ.qzv")
-    elif not run_command(
-        "qiime feature-table tabulate-seqs \
-        --i-data dada-rep-seqs.qza \
-        --o-visualization dada-rep-seqs-summ.qzv",
-        "Representative sequences tabulation"
-    ):
-        fly_message("Failed to tabulate representative sequences. Continuing anyway...", "warning")
-    else:
-        open_qzv_file("dada-rep-seqs-summ.qzv")
-    
-    # Step 7: Summarize feature table
-    fly_message("\n===== STEP 7: SUMMARIZING FEATURE TABLE =====", "info")
-    if check_output_exists("dada-table-summ.qzv"):
-        fly_message("Feature table summarization", "skip")
-        if input("🪰❓ Would you like to view the feature table summary? (yes/no): ").strip().lower() in ["yes", "y"]:
-            open_qzv_file("dada-table-summ.qzv")
-    elif not run_command(
-        "qiime feature-table summarize \
-        --i-table dada-table.qza \
-        --o-visualization dada-table-summ.qzv \
-        --m-sample-metadata-file metadata.tsv",
-        "Feature table summarization"
-    ):
-        fly_message("Failed to summarize feature table. Continuing anyway...", "warning")
-    else:
-        open_qzv_file("dada-table-summ.qzv")
-    
-    # Step 8: Sequence alignment with MAFFT
-    fly_message("\n===== STEP 8: ALIGNING SEQUENCES WITH MAFFT =====", "info")
-    if check_output_exists("dada-rep-seqs-alligned.qza"):
-        fly_message("MAFFT alignment", "skip")
-    elif not run_command(
-        "qiime alignment mafft \
-        --i-sequences dada-rep-seqs.qza \
-        --o-alignment dada-rep-seqs-alligned.qza",
-        "MAFFT alignment"
-    ):
-        fly_message("Failed to align sequences. Exiting...", "error")
+    elif not run_step(dada2_step):
+        fly_message("Failed to denoise sequences. Exiting...", "error")
         return
+    else:
+        stale_outputs.update(dada2_step.outputs)
     
-    # Step 9: Mask alignment
-    fly_message("\n===== STEP 9: MASKING ALIGNMENT =====", "info")
-    if check_output_exists("dada-rep-seqs-alligned-masked.qza"):
-        fly_message("Alignment masking", "skip")
-    elif not run_command(
-        "qiime alignment mask \
-        --i-alignment dada-rep-seqs-alligned.qza \
-        --o-masked-alignment dada-rep-seqs-alligned-masked.qza",
-        "Alignment masking"
-    ):
-        fly_message("Failed to mask alignment. Exiting...", "error")
-        return
+    # Steps 5-18 only need the DADA2 outputs, the classifier and the metadata, and none of them
+    # prompt for input, so they are run together as a dependency graph. Each step starts as soon
+    # as the steps producing its inputs finish, e.g. building the tree (steps 8-11) runs alongside
+    # taxonomic classification (step 12). Each entry is (header, step, what to call it when
+    # offering to view an existing visualization, what failed, whether to exit on failure).
+    graph_steps = [
+        (
+            "\n===== STEP 5: VIEWING DENOISING STATISTICS =====",
+            build_command(
+                [
+                    "qiime", "metadata", "tabulate",
+                    "--m-input-file", "dada-denoising-stats.qza",
+                    "--o-visualization", "dada-denoising-stats-summ.qzv",
+                ],
+                "Denoising stats tabulation",
+                inputs=["dada-denoising-stats.qza"],
+                outputs=["dada-denoising-stats-summ.qzv"]
+            ),
+            "the denoising stats",
+            "tabulate denoising stats",
+            False
+        ),
+        (
+            "\n===== STEP 6: TABULATING REPRESENTATIVE SEQUENCES =====",
+            build_command(
+                [
+                    "qiime", "feature-table", "tabulate-seqs",
+                    "--i-data", "dada-rep-seqs.qza",
+                    "--o-visualization", "dada-rep-seqs-summ.qzv",
+                ],
+                "Representative sequences tabulation",
+                inputs=["dada-rep-seqs.qza"],
+                outputs=["dada-rep-seqs-summ.qzv"]
+            ),
+            "the representative sequences",
+            "tabulate representative sequences",
+            False
+        ),
+        (
+            "\n===== STEP 7: SUMMARIZING FEATURE TABLE =====",
+            build_command(
+                [
+                    "qiime", "feature-table", "summarize",
+                    "--i-table", "dada-table.qza",
+                    "--o-visualization", "dada-table-summ.qzv",
+                    "--m-sample-metadata-file", "metadata.tsv",
+                ],
+                "Feature table summarization",
+                inputs=["dada-table.qza", "metadata.tsv"],
+                outputs=["dada-table-summ.qzv"]
+            ),
+            "the feature table summary",
+            "summarize feature table",
+            False
+        ),
+        (
+            "\n===== STEP 8: ALIGNING SEQUENCES WITH MAFFT =====",
+            build_command(
+                [
+                    "qiime", "alignment", "mafft",
+                    "--i-sequences", "dada-rep-seqs.qza",
+                    "--p-n-threads", threads,
+                    "--o-alignment", "dada-rep-seqs-alligned.qza",
+                ],
+                "MAFFT alignment",
+                inputs=["dada-rep-seqs.qza"],
+                outputs=["dada-rep-seqs-alligned.qza"]
+            ),
+            None,
+            "align sequences",
+            True
+        ),
+        (
+            "\n===== STEP 9: MASKING ALIGNMENT =====",
+            build_command(
+                [
+                    "qiime", "alignment", "mask",
+                    "--i-alignment", "dada-rep-seqs-alligned.qza",
+                    "--o-masked-alignment", "dada-rep-seqs-alligned-masked.qza",
+                ],
+                "Alignment masking",
+                inputs=["dada-rep-seqs-alligned.qza"],
+                outputs=["dada-rep-seqs-alligned-masked.qza"]
+            ),
+            None,
+            "mask alignment",
+            True
+        ),
+        (
+            "\n===== STEP 10: BUILDING PHYLOGENETIC TREE WITH FASTTREE =====",
+            build_command(
+                [
+                    "qiime", "phylogeny", "fasttree",
+                    "--i-alignment", "dada-rep-seqs-alligned-masked.qza",
+                    "--p-n-threads", threads,
+                    "--o-tree", "dada-unrooted-tree.qza",
+                ],
+                "FastTree phylogeny construction",
+                inputs=["dada-rep-seqs-alligned-masked.qza"],
+                outputs=["dada-unrooted-tree.qza"]
+            ),
+            None,
+            "build phylogenetic tree",
+            True
+        ),
+        (
+            "\n===== STEP 11: ROOTING THE PHYLOGENETIC TREE =====",
+            build_command(
+                [
+                    "qiime", "phylogeny", "midpoint-root",
+                    "--i-tree", "dada-unrooted-tree.qza",
+                    "--o-rooted-tree", "dada-rooted-tree.qza",
+                ],
+                "Tree rooting",
+                inputs=["dada-unrooted-tree.qza"],
+                outputs=["dada-rooted-tree.qza"]
+            ),
+            None,
+            "root the tree",
+            True
+        ),
+        (
+            "\n===== STEP 12: TAXONOMIC CLASSIFICATION =====",
+            build_command(
+                [
+                    "qiime", "feature-classifier", "classify-sklearn",
+                    "--i-classifier", "classifier.qza",
+                    "--i-reads", "dada-rep-seqs.qza",
+                    "--p-n-jobs", threads,
+                    "--o-classification", "taxonomy.qza",
+                ],
+                "Taxonomic classification",
+                inputs=["classifier.qza", "dada-rep-seqs.qza"],
+                outputs=["taxonomy.qza"]
+            ),
+            None,
+            "classify taxonomy",
+            True
+        ),
+        (
+            "\n===== STEP 13: VISUALIZING TAXONOMY =====",
+            build_command(
+                [
+                    "qiime", "metadata", "tabulate",
+                    "--m-input-file", "taxonomy.qza",
+                    "--o-visualization", "taxonomy.qzv",
+                ],
+                "Taxonomy visualization",
+                inputs=["taxonomy.qza"],
+                outputs=["taxonomy.qzv"]
+            ),
+            "the taxonomy visualization",
+            "visualize taxonomy",
+            False
+        ),
+        (
+            "\n===== STEP 14: FILTERING FEATURE TABLE =====",
+            build_command(
+                [
+                    "qiime", "feature-table", "filter-features",
+                    "--i-table", "dada-table.qza",
+                    "--p-min-samples", "2",
+                    "--o-filtered-table", "dada-filtered-table.qza",
+                ],
+                "Feature table filtering",
+                inputs=["dada-table.qza"],
+                outputs=["dada-filtered-table.qza"]
+            ),
+            None,
+            "filter feature table",
+            True
+        ),
+        (
+            "\n===== STEP 15: FILTERING MITOCHONDRIA AND CHLOROPLAST =====",
+            build_command(
+                [
+                    "qiime", "taxa", "filter-table",
+                    "--i-table", "dada-filtered-table.qza",
+                    "--i-taxonomy", "taxonomy.qza",
+                    "--p-exclude", "mitochondria,chloroplast",
+                    "--o-filtered-table", "dada-filtered-nmnc-table.qza",
+                ],
+                "Mitochondria and chloroplast filtering",
+                inputs=["dada-filtered-table.qza", "taxonomy.qza"],
+                outputs=["dada-filtered-nmnc-table.qza"]
+            ),
+            None,
+            "filter mitochondria and chloroplast",
+            True
+        ),
+        (
+            "\n===== STEP 16: COLLAPSING TAXONOMY TO GENUS LEVEL =====",
+            build_command(
+                [
+                    "qiime", "taxa", "collapse",
+                    "--i-table", "dada-filtered-nmnc-table.qza",
+                    "--i-taxonomy", "taxonomy.qza",
+                    "--p-level", "6",
+                    "--o-collapsed-table", "dada-filtered-nmnc-table-l6.qza",
+                ],
+                "Taxonomy collapsing",
+                inputs=["dada-filtered-nmnc-table.qza", "taxonomy.qza"],
+                outputs=["dada-filtered-nmnc-table-l6.qza"]
+            ),
+            None,
+            "collapse taxonomy",
+            True
+        ),
+        (
+            "\n===== STEP 17: SUMMARIZING COLLAPSED TABLE =====",
+            build_command(
+                [
+                    "qiime", "feature-table", "summarize",
+                    "--i-table", "dada-filtered-nmnc-table-l6.qza",
+                    "--o-visualization", "dada-filtered-nmnc-table-l6.qzv",
+                    "--m-sample-metadata-file", "metadata.tsv",
+                ],
+                "Collapsed table summarization",
+                inputs=["dada-filtered-nmnc-table-l6.qza", "metadata.tsv"],
+                outputs=["dada-filtered-nmnc-table-l6.qzv"]
+            ),
+            "the collapsed table visualization",
+            "summarize collapsed table",
+            False
+        ),
+        (
+            "\n===== STEP 18: GENERATING TAXONOMY BARPLOTS =====",
+            build_command(
+                [
+                    "qiime", "taxa", "barplot",
+                    "--i-table", "dada-filtered-nmnc-table.qza",
+                    "--i-taxonomy", "taxonomy.qza",
+                    "--m-metadata-file", "metadata.tsv",
+                    "--o-visualization", "taxa-bar-plots.qzv",
+                ],
+                "Taxonomy barplot generation",
+                inputs=["dada-filtered-nmnc-table.qza", "taxonomy.qza", "metadata.tsv"],
+                outputs=["taxa-bar-plots.qzv"]
+            ),
+            "the taxonomy barplots",
+            "generate taxonomy barplots",
+            False
+        ),
+    ]
     
-    # Step 10: Build phylogenetic tree with FastTree
-    fly_message("\n===== STEP 10: BUILDING PHYLOGENETIC TREE WITH FASTTREE =====", "info")
-    if check_output_exists("dada-unrooted-tree.qza"):
-        fly_message("FastTree phylogeny construction", "skip")
-    elif not run_command(
-        "qiime phylogeny fasttree \
-        --i-alignment dada-rep-seqs-alligned-masked.qza \
-        --o-tree dada-unrooted-tree.qza",
-        "FastTree phylogeny construction"
-    ):
-        fly_message("Failed to build phylogenetic tree. Exiting...", "error")
-        return
+    pending_steps = []
+    for header, step, view_name, action, required in graph_steps:
+        fly_message(header, "info")
+        if stale_outputs.isdisjoint(step.inputs) and is_up_to_date(step):
+            fly_message(step.description, "skip")
+            if view_name and input(f"🪰❓ Would you like to view {view_name}? (yes/no): ").strip().lower() in ["yes", "y"]:
+                open_qzv_file(step.outputs[0])
+        else:
+            pending_steps.append((step, view_name, action, required))
+            stale_outputs.update(step.outputs)
     
-    # Step 11: Root the tree
-    fly_message("\n===== STEP 11: ROOTING THE PHYLOGENETIC TREE =====", "info")
-    if check_output_exists("dada-rooted-tree.qza"):
-        fly_message("Tree rooting", "skip")
-    elif not run_command(
-        "qiime phylogeny midpoint-root \
-        --i-tree dada-unrooted-tree.qza \
-        --o-rooted-tree dada-rooted-tree.qza",
-        "Tree rooting"
-    ):
-        fly_message("Failed to root the tree. Exiting...", "error")
-        return
+    if pending_steps:
+        fly_message("Running the remaining steps, with independent steps in parallel...", "info")
+        fly_message("This may take a while... Flies are patient creatures!", "info")
+    results = run_batch([step for step, _, _, _ in pending_steps])
+    for (step, view_name, action, required), succeeded in zip(pending_steps, results):
+        if succeeded:
+            if view_name:
+                open_qzv_file(step.outputs[0])
+        elif required:
+            fly_message(f"Failed to {action}. Exiting...", "error")
+            return
+        else:
+            fly_message(f"Failed to {action}. Continuing anyway...", "warning")
     
-    # Step 12: Alpha rarefaction
-    fly_message("\n===== STEP 12: ALPHA RAREFACTION ANALYSIS =====", "info")
+    # Step 19: Alpha rarefaction
+    fly_message("\n===== STEP 19: ALPHA RAREFACTION ANALYSIS =====", "info")
     
+    fly_message("We need to determine a rarefaction depth for diversity analyses", "input")
     if check_output_exists("alpha-rarefaction.qzv"):
-        fly_message("Alpha rarefaction analysis", "skip")
         if input("🪰❓ Would you like to view the existing alpha rarefaction plot? (yes/no): ").strip().lower() in ["yes", "y"]:
             open_qzv_file("alpha-rarefaction.qzv")
-        max_depth = input("🪰❓ Enter the maximum rarefaction depth you determined from the plot: ")
     else:
-        fly_message("We need to determine a rarefaction depth for diversity analyses", "input")
         fly_message("Let's generate a rarefaction curve to help with this decision", "info")
-        
-        # Ask for max depth for rarefaction curve
-        max_depth = input("🪰❓ Enter maximum rarefaction depth (suggested: check dada-table-summ.qzv for guidance): ")
-        
-        if not run_command(
-            f"qiime diversity alpha-rarefaction \
-            --i-table dada-table.qza \
-            --i-phylogeny dada-rooted-tree.qza \
-            --p-max-depth {max_depth} \
-            --m-metadata-file metadata.tsv \
-            --o-visualization alpha-rarefaction.qzv",
-            "Alpha rarefaction analysis"
-        ):
-            fly_message("Failed to perform alpha rarefaction. Exiting...", "error")
-            return
-        else:
-            open_qzv_file("alpha-rarefaction.qzv")
     
-    fly_message("Please examine the rarefaction curves to determine an appropriate sampling depth", "input")
-    fly_message("Look for the plateau in the curves and choose a depth that retains most samples", "info")
-    input("Press Enter to continue once you've reviewed the rarefaction curves...")
+    # Ask for max depth for rarefaction curve
+    max_depth = input("🪰❓ Enter maximum rarefaction depth (suggested: check dada-table-summ.qzv for guidance): ").strip()
     
-    # Step 13: Taxonomic classification
-    fly_message("\n===== STEP 13: TAXONOMIC CLASSIFICATION =====", "info")
-    fly_message("This step may take a while... Flies are patient creatures!", "info")
-    if check_output_exists("taxonomy.qza"):
-        fly_message("Taxonomic classification", "skip")
-    elif not run_command(
-        "qiime feature-classifier classify-sklearn \
-        --i-classifier classifier.qza \
-        --i-reads dada-rep-seqs.qza \
-        --o-classification taxonomy.qza",
-        "Taxonomic classification"
-    ):
-        fly_message("Failed to classify taxonomy. Exiting...", "error")
+    rarefaction_step = build_command(
+        [
+            "qiime", "diversity", "alpha-rarefaction",
+            "--i-table", "dada-table.qza",
+            "--i-phylogeny", "dada-rooted-tree.qza",
+            "--p-max-depth", max_depth,
+            "--m-metadata-file", "metadata.tsv",
+            "--o-visualization", "alpha-rarefaction.qzv",
+        ],
+        "Alpha rarefaction analysis",
+        inputs=["dada-table.qza", "dada-rooted-tree.qza", "metadata.tsv"],
+        outputs=["alpha-rarefaction.qzv"]
+    )
+    if stale_outputs.isdisjoint(rarefaction_step.inputs) and is_up_to_date(rarefaction_step):
+        fly_message("Alpha rarefaction analysis", "skip")
+    elif not run_step(rarefaction_step):
+        fly_message("Failed to perform alpha rarefaction. Exiting...", "error")
         return
-    
-    # Step 14: Visualize taxonomy
-    fly_message("\n===== STEP 14: VISUALIZING TAXONOMY =====", "info")
-    if check_output_exists("taxonomy.qzv"):
-        fly_message("Taxonomy visualization", "skip")
-        if input("🪰❓ Would you like to view the taxonomy visualization? (yes/no): ").strip().lower() in ["yes", "y"]:
-            open_qzv_file("taxonomy.qzv")
-    elif not run_command(
-        "qiime metadata tabulate \
-        --m-input-file taxonomy.qza \
-        --o-visualization taxonomy.qzv",
-        "Taxonomy visualization"
-    ):
-        fly_message("Failed to visualize taxonomy. Continuing anyway...", "warning")
     else:
-        open_qzv_file("taxonomy.qzv")
-    
-    # Step 15: Filter feature table
-    fly_message("\n===== STEP 15: FILTERING FEATURE TABLE =====", "info")
-    if check_output_exists("dada-filtered-table.qza"):
-        fly_message("Feature table filtering", "skip")
-    elif not run_command(
-        "qiime feature-table filter-features \
-        --i-table dada-table.qza \
-        --p-min-samples 2 \
-        --o-filtered-table dada-filtered-table.qza",
-        "Feature table filtering"
-    ):
-        fly_message("Failed to filter feature table. Exiting...", "error")
-        return
+        stale_outputs.update(rarefaction_step.outputs)
+        open_qzv_file("alpha-rarefaction.qzv")
     
-    # Step 16: Filter out mitochondria and chloroplast
-    fly_message("\n===== STEP 16: FILTERING MITOCHONDRIA AND CHLOROPLAST =====", "info")
-    if check_output_exists("dada-filtered-nmnc-table.qza"):
-        fly_message("Mitochondria and chloroplast filtering", "skip")
-    elif not run_command(
-        "qiime taxa filter-table \
-        --i-table dada-filtered-table.qza \
-        --i-taxonomy taxonomy.qza \
-        --p-exclude mitochondria,chloroplast \
-        --o-filtered-table dada-filtered-nmnc-table.qza",
-        "Mitochondria and chloroplast filtering"
-    ):
-        fly_message("Failed to filter mitochondria and chloroplast. Exiting...", "error")
-        return
-    
-    # Step 17: Collapse taxonomy to level 6 (genus)
-    fly_message("\n===== STEP 17: COLLAPSING TAXONOMY TO GENUS LEVEL =====", "info")
-    if check_output_exists("dada-filtered-nmnc-table-l6.qza"):
-        fly_message("Taxonomy collapsing", "skip")
-    elif not run_command(
-        "qiime taxa collapse \
-        --i-table dada-filtered-nmnc-table.qza \
-        --i-taxonomy taxonomy.qza \
-        --p-level 6 \
-        --o-collapsed-table dada-filtered-nmnc-table-l6.qza",
-        "Taxonomy collapsing"
-    ):
-        fly_message("Failed to collapse taxonomy. Exiting...", "error")
-        return
-    
-    # Step 18: Summarize collapsed table
-    fly_message("\n===== STEP 18: SUMMARIZING COLLAPSED TABLE =====", "info")
-    if check_output_exists("dada-filtered-nmnc-table-l6.qzv"):
-        fly_message("Collapsed table summarization", "skip")
-        if input("🪰❓ Would you like to view the collapsed table visualization? (yes/no): ").strip().lower() in ["yes", "y"]:
-            open_qzv_file("dada-filtered-nmnc-table-l6.qzv")
-    elif not run_command(
-        "qiime feature-table summarize \
-        --i-table dada-filtered-nmnc-table-l6.qza \
-        --o-visualization dada-filtered-nmnc-table-l6.qzv \
-        --m-sample-metadata-file metadata.tsv",
-        "Collapsed table summarization"
-    ):
-        fly_message("Failed to summarize collapsed table. Continuing anyway...", "warning")
-    else:
-        open_qzv_file("dada-filtered-nmnc-table-l6.qzv")
-    
-    # Step 19: Generate taxa barplots
-    fly_message("\n===== STEP 19: GENERATING TAXONOMY BARPLOTS =====", "info")
-    if check_output_exists("taxa-bar-plots.qzv"):
-        fly_message("Taxonomy barplot generation", "skip")
-        if input("🪰❓ Would you like to view the taxonomy barplots? (yes/no): ").strip().lower() in ["yes", "y"]:
-            open_qzv_file("taxa-bar-plots.qzv")
-    elif not run_command(
-        "qiime taxa barplot \
-        --i-table dada-filtered-nmnc-table.qza \
-        --i-taxonomy taxonomy.qza \
-        --m-metadata-file metadata.tsv \
-        --o-visualization taxa-bar-plots.qzv",
-        "Taxonomy barplot generation"
-    ):
-        fly_message("Failed to generate taxonomy barplots. Continuing anyway...", "warning")
-    else:
-        open_qzv_file("taxa-bar-plots.qzv")
+    fly_message("Please examine the rarefaction curves to determine an appropriate sampling depth", "input")
+    fly_message("Look for the plateau in the curves and choose a depth that retains most samples", "info")
+    input("Press Enter to continue once you've reviewed the rarefaction curves...")
     
     # Step 20: Core metrics phylogenetic analysis
     fly_message("\n===== STEP 20: CORE METRICS PHYLOGENETIC ANALYSIS =====", "info")
@@ -532,148 +1352,247 @@ def main():
         "metrics/jaccard_distance_matrix.qza", "metrics/bray_curtis_distance_matrix.qza"
     ]
     
-    if check_output_exists(metrics_outputs):
+    fly_message("Based on your examination of the alpha rarefaction curves, we need to set a sampling depth", "input")
+    sampling_depth = input("🪰❓ Enter sampling depth for diversity analyses: ").strip()
+    
+    core_metrics_step = build_command(
+        [
+            "qiime", "diversity", "core-metrics-phylogenetic",
+            "--i-phylogeny", "dada-rooted-tree.qza",
+            "--i-table", "dada-filtered-nmnc-table.qza",
+            "--p-sampling-depth", sampling_depth,
+            "--m-metadata-file", "metadata.tsv",
+            "--p-n-jobs-or-threads", threads,
+            "--output-dir", "metrics.tmp",
+        ],
+        "Core metrics phylogenetic analysis",
+        inputs=["dada-rooted-tree.qza", "dada-filtered-nmnc-table.qza", "metadata.tsv"],
+        outputs=metrics_outputs
+    )
+    if stale_outputs.isdisjoint(core_metrics_step.inputs) and is_up_to_date(core_metrics_step):
         fly_message("Core metrics phylogenetic analysis", "skip")
-        sampling_depth = input("🪰❓ Enter the sampling depth you previously used for diversity analyses: ")
     else:
-        fly_message("Based on your examination of the alpha rarefaction curves, we need to set a sampling depth", "input")
-        sampling_depth = input("🪰❓ Enter sampling depth for diversity analyses: ")
-        
-        if not run_command(
-            f"qiime diversity core-metrics-phylogenetic \
-            --i-phylogeny dada-rooted-tree.qza \
-            --i-table dada-filtered-nmnc-table.qza \
-            --p-sampling-depth {sampling_depth} \
-            --m-metadata-file metadata.tsv \
-            --output-dir metrics",
-            "Core metrics phylogenetic analysis"
-        ):
+        # --output-dir refuses an existing directory, so the results go to a new one that only
+        # replaces the previous results once it is complete
+        if os.path.isdir("metrics.tmp"):
+            shutil.rmtree("metrics.tmp")
+        add_to_plan("Clear out an unfinished core metrics run", ["rm", "-rf", "metrics.tmp"])
+        if not run_step(core_metrics_step):
             fly_message("Failed to perform core metrics analysis. Exiting...", "error")
             return
+        if os.path.isdir("metrics"):
+            shutil.rmtree("metrics")
+        os.replace("metrics.tmp", "metrics")
+        add_to_plan("Replace the previous core metrics results", ["rm", "-rf", "metrics"], ["mv", "metrics.tmp", "metrics"])
+        stale_outputs.update(core_metrics_step.outputs)
     
     # Step 21: Export artifacts to usable formats
     fly_message("\n===== STEP 21: EXPORTING ARTIFACTS TO USABLE FORMATS =====", "info")
     fly_message("Creating 'exports' directory for exported files...", "info")
     
     # Create exports directory if it doesn't exist
-    if not os.path.exists("exports"):
-        os.makedirs("exports")
-    
-    # Export feature table to biom format
-    fly_message("Exporting feature table to biom format...", "info")
-    if check_output_exists("exports/feature-table/feature-table.biom"):
-        fly_message("Feature table export", "skip")
-    elif not run_command(
-        "qiime tools export \
-        --input-path dada-filtered-nmnc-table.qza \
-        --output-path exports/feature-table",
-        "Feature table export"
-    ):
-        fly_message("Failed to export feature table. Continuing anyway...", "warning")
-    
-    # Convert biom to TSV
-    fly_message("Converting feature table from biom to TSV format...", "info")
-    if check_output_exists("exports/feature-table/feature-table.tsv"):
-        fly_message("Biom to TSV conversion", "skip")
-    elif not run_command(
-        "biom convert \
-        -i exports/feature-table/feature-table.biom \
-        -o exports/feature-table/feature-table.tsv \
-        --to-tsv",
-        "Biom to TSV conversion"
-    ):
-        fly_message("Failed to convert feature table to TSV. Continuing anyway...", "warning")
-    
-    # Export taxonomy
-    fly_message("Exporting taxonomy assignments...", "info")
-    if check_output_exists("exports/taxonomy/taxonomy.tsv"):
-        fly_message("Taxonomy export", "skip")
-    elif not run_command(
-        "qiime tools export \
-        --input-path taxonomy.qza \
-        --output-path exports/taxonomy",
-        "Taxonomy export"
-    ):
-        fly_message("Failed to export taxonomy. Continuing anyway...", "warning")
-    
-    # Export representative sequences
-    fly_message("Exporting representative sequences...", "info")
-    if check_output_exists("exports/rep-seqs/dna-sequences.fasta"):
-        fly_message("Representative sequences export", "skip")
-    elif not run_command(
-        "qiime tools export \
-        --input-path dada-rep-seqs.qza \
-        --output-path exports/rep-seqs",
-        "Representative sequences export"
-    ):
-        fly_message("Failed to export representative sequences. Continuing anyway...", "warning")
-    
-    # Export phylogenetic tree
-    fly_message("Exporting phylogenetic tree...", "info")
-    if check_output_exists("exports/phylogeny/tree.nwk"):
-        fly_message("Phylogenetic tree export", "skip")
-    elif not run_command(
-        "qiime tools export \
-        --input-path dada-rooted-tree.qza \
-        --output-path exports/phylogeny",
-        "Phylogenetic tree export"
-    ):
-        fly_message("Failed to export phylogenetic tree. Continuing anyway...", "warning")
-    
-    # Export alpha diversity metrics
-    fly_message("Exporting alpha diversity metrics...", "info")
-    for metric in ["observed_features", "shannon", "faith_pd", "evenness"]:
-        if os.path.exists(f"metrics/{metric}_vector.qza"):
-            if check_output_exists(f"exports/alpha-diversity/{metric}/alpha-diversity.tsv"):
-                fly_message(f"{metric} export", "skip")
-            elif not run_command(
-                f"qiime tools export \
-                --input-path metrics/{metric}_vector.qza \
-                --output-path exports/alpha-diversity/{metric}",
-                f"{metric} export"
-            ):
-                fly_message(f"Failed to export {metric}. Continuing anyway...", "warning")
-    
-    # Export beta diversity distance matrices
-    fly_message("Exporting beta diversity distance matrices...", "info")
-    for metric in ["unweighted_unifrac", "weighted_unifrac", "jaccard", "bray_curtis"]:
-        if os.path.exists(f"metrics/{metric}_distance_matrix.qza"):
-            if check_output_exists(f"exports/beta-diversity/{metric}/distance-matrix.tsv"):
-                fly_message(f"{metric} export", "skip")
-            elif not run_command(
-                f"qiime tools export \
-                --input-path metrics/{metric}_distance_matrix.qza \
-                --output-path exports/beta-diversity/{metric}",
-                f"{metric} export"
-            ):
-                fly_message(f"Failed to export {metric}. Continuing anyway...", "warning")
-    
-    # Export collapsed taxonomic table
-    fly_message("Exporting collapsed taxonomic table...", "info")
-    if check_output_exists("exports/collapsed-table/feature-table.biom"):
-        fly_message("Collapsed table export", "skip")
-    elif not run_command(
-        "qiime tools export \
-        --input-path dada-filtered-nmnc-table-l6.qza \
-        --output-path exports/collapsed-table",
-        "Collapsed table export"
-    ):
-        fly_message("Failed to export collapsed table. Continuing anyway...", "warning")
-    
-    # Convert collapsed biom to TSV
-    fly_message("Converting collapsed table from biom to TSV format...", "info")
-    if check_output_exists("exports/collapsed-table/feature-table-l6.tsv"):
-        fly_message("Collapsed biom to TSV conversion", "skip")
-    elif not run_command(
-        "biom convert \
-        -i exports/collapsed-table/feature-table.biom \
-        -o exports/collapsed-table/feature-table-l6.tsv \
-        --to-tsv",
-        "Collapsed biom to TSV conversion"
-    ):
-        fly_message("Failed to convert collapsed table to TSV. Continuing anyway...", "warning")
-    
-    fly_message("All artifacts have been exported to the 'exports' directory!", "success")
+    os.makedirs("exports", exist_ok=True)
+    
+    # Exports and biom to TSV conversions run as one dependency graph: each export only reads a
+    # single .qza, and each conversion starts as soon as the export it reads from has finished
+    exports = [
+        ("taxonomy.qza", "exports/taxonomy", "taxonomy.tsv", "Taxonomy export", "taxonomy"),
+        ("dada-rep-seqs.qza", "exports/rep-seqs", "dna-sequences.fasta", "Representative sequences export", "representative sequences"),
+        ("dada-rooted-tree.qza", "exports/phylogeny", "tree.nwk", "Phylogenetic tree export", "phylogenetic tree"),
+    ]
+    # Alpha diversity vectors and beta diversity distance matrices from core metrics
+    diversity_metrics = [
+        ("observed_features", "vector", "alpha-diversity", "alpha-diversity.tsv"),
+        ("shannon", "vector", "alpha-diversity", "alpha-diversity.tsv"),
+        ("faith_pd", "vector", "alpha-diversity", "alpha-diversity.tsv"),
+        ("evenness", "vector", "alpha-diversity", "alpha-diversity.tsv"),
+        ("unweighted_unifrac", "distance_matrix", "beta-diversity", "distance-matrix.tsv"),
+        ("weighted_unifrac", "distance_matrix", "beta-diversity", "distance-matrix.tsv"),
+        ("jaccard", "distance_matrix", "beta-diversity", "distance-matrix.tsv"),
+        ("bray_curtis", "distance_matrix", "beta-diversity", "distance-matrix.tsv"),
+    ]
+    for metric, artifact, export_dir, output_file in diversity_metrics:
+        if exists(f"metrics/{metric}_{artifact}.qza"):
+            exports.append((f"metrics/{metric}_{artifact}.qza", f"exports/{export_dir}/{metric}", output_file, f"{metric} export", metric))
+    # Feature tables are exported to biom and also converted to TSV
+    # (gzip-compressed if requested, which needs the biom Python API)
+    biom_in_process = importlib.util.find_spec("biom") is not None
+    tsv_suffixes = {"plain": [".tsv"], "gzip": [".tsv.gz"], "both": [".tsv", ".tsv.gz"]}[args.tsv_format]
+    if args.tsv_format != "plain" and not biom_in_process:
+        fly_message("The biom Python package is needed to write gzip-compressed TSVs, writing plain TSVs instead", "warning")
+        tsv_suffixes = [".tsv"]
+    tables = [
+        ("dada-filtered-nmnc-table.qza", "exports/feature-table", "feature-table", "Feature table export", "Biom to TSV conversion", "feature table"),
+        ("dada-filtered-nmnc-table-l6.qza", "exports/collapsed-table", "feature-table-l6", "Collapsed table export", "Collapsed biom to TSV conversion", "collapsed table"),
+    ]
+    tables = [
+        (input_path, output_dir, [f"{output_dir}/{tsv_name}{suffix}" for suffix in tsv_suffixes], export_description, convert_description, name)
+        for input_path, output_dir, tsv_name, export_description, convert_description, name in tables
+    ]
+    
+    fly_message("Exporting feature table, taxonomy, sequences, tree, diversity metrics and collapsed table...", "info")
+    # Export in-process with the QIIME2 Python API when it is importable, which avoids
+    # starting a new QIIME2 CLI (and loading every plugin) once per exported artifact
+    in_process = importlib.util.find_spec("qiime2") is not None
+    pending_tasks = []
+    # With --prune-intermediates, each table's biom file is deleted once its TSVs are written,
+    # including one left by an earlier run without the flag
+    prune_steps = {}
+    if args.prune_intermediates:
+        for input_path, output_dir, tsv_paths, description, _, name in tables:
+            prune_steps[name] = build_command(
+                functools.partial(remove_intermediate_biom, f"{output_dir}/feature-table.biom", tsv_paths),
+                description,
+                inputs=[input_path],
+                outputs=tsv_paths
+            )
+    if in_process:
+        # Write each table's biom and TSV files from a single load of the artifact,
+        # rather than exporting the biom file and reading it back to convert it
+        for input_path, output_dir, tsv_paths, description, _, name in tables:
+            # The biom file is only an intermediate here, so don't write it at all when pruning
+            biom_path = None if args.prune_intermediates else f"{output_dir}/feature-table.biom"
+            task = build_command(
+                functools.partial(export_feature_table, input_path, biom_path, tsv_paths),
+                description,
+                inputs=[input_path],
+                outputs=[biom_path, *tsv_paths] if biom_path else tsv_paths
+            )
+            if stale_outputs.isdisjoint(task.inputs) and is_up_to_date(task):
+                fly_message(description, "skip")
+            else:
+                pending_tasks.append((f"export {name}", task))
+        conversions = []
+    else:
+        if args.prune_intermediates:
+            # Pruned biom files are gone on rerun, so a table whose TSVs were made from the
+            # same artifact is skipped without exporting and converting it again
+            unpruned_tables = []
+            for table, prune_step in zip(tables, prune_steps.values()):
+                if stale_outputs.isdisjoint(prune_step.inputs) and is_up_to_date(prune_step):
+                    fly_message(prune_step.description, "skip")
+                else:
+                    unpruned_tables.append(table)
+            tables = unpruned_tables
+        exports += [
+            (input_path, output_dir, "feature-table.biom", description, name)
+            for input_path, output_dir, _, description, _, name in tables
+        ]
+        conversions = [
+            (f"{output_dir}/feature-table.biom", tsv_paths, description, name)
+            for _, output_dir, tsv_paths, _, description, name in tables
+        ]
+    
+    for input_path, output_dir, output_file, description, name in exports:
+        output_path = f"{output_dir}/{output_file}"
+        if in_process:
+            task = build_command(
+                functools.partial(export_artifact, input_path, output_dir),
+                description,
+                inputs=[input_path],
+                outputs=[output_path]
+            )
+        else:
+            task = build_command(
+                [
+                    "qiime", "tools", "export",
+                    "--input-path", input_path,
+                    "--output-path", output_dir,
+                ],
+                description,
+                inputs=[input_path],
+                outputs=[output_path]
+            )
+        if stale_outputs.isdisjoint(task.inputs) and is_up_to_date(task):
+            fly_message(description, "skip")
+        else:
+            pending_tasks.append((f"export {name}", task))
+    
+    exporting_in_process = in_process and bool(pending_tasks)
+    
+    if conversions:
+        fly_message("Converting feature tables from biom to TSV format...", "info")
+    # Likewise convert with the biom Python API when available instead of starting the biom CLI
+    # Exported tables that are about to be rewritten need converting again
+    stale_outputs.update(output for _, task in pending_tasks for output in task.outputs)
+    for biom_path, tsv_paths, description, name in conversions:
+        if biom_in_process:
+            task = build_command(
+                functools.partial(convert_biom_to_tsv, biom_path, tsv_paths),
+                description,
+                inputs=[biom_path],
+                outputs=tsv_paths
+            )
+        else:
+            # Without the biom Python API only a single plain TSV is written
+            task = build_command(
+                [
+                    "biom", "convert",
+                    "-i", biom_path,
+                    "-o", tsv_paths[0],
+                    "--to-tsv",
+                ],
+                description,
+                inputs=[biom_path],
+                outputs=tsv_paths
+            )
+        if stale_outputs.isdisjoint(task.inputs) and is_up_to_date(task):
+            fly_message(description, "skip")
+        else:
+            pending_tasks.append((f"convert {name} to TSV", task))
+    
+    if exporting_in_process:
+        # Load the plugins once up front so the export threads don't race to initialize them
+        from qiime2.sdk import PluginManager
+        PluginManager()
+    
+    scratch_dir = None
+    if args.scratch_dir and pending_tasks:
+        if BATCH_MANIFEST:
+            fly_message("--scratch-dir is ignored with --batch-manifest, since array tasks may run on other nodes", "warning")
+        else:
+            scratch_dir = tempfile.mkdtemp(prefix="qiime-time-", dir=args.scratch_dir)
+    
+    tasks = [task for _, task in pending_tasks]
+    if scratch_dir:
+        # Write the exports to scratch, then copy them into 'exports' in one go once they are all done
+        staged_tasks = []
+        staged_outputs = set()
+        for task in tasks:
+            staged_task = stage_step(task, "exports", scratch_dir, staged_outputs)
+            staged_outputs.update(task.outputs)
+            for output in staged_task.outputs:
+                os.makedirs(os.path.dirname(output), exist_ok=True)
+            staged_tasks.append(staged_task)
+        # The plan script gets the unstaged steps, since the scratch directory is gone after this run
+        results = run_batch(staged_tasks, plan_jobs=tasks)
+        shutil.copytree(os.path.join(scratch_dir, "exports"), "exports", dirs_exist_ok=True)
+        shutil.rmtree(scratch_dir)
+        # Only now are the outputs in place, so record the steps under their real paths
+        for task, succeeded in zip(tasks, results):
+            if succeeded:
+                record_step(task)
+    else:
+        results = run_batch(tasks)
+    failed_actions = set()
+    for (action, _), succeeded in zip(pending_tasks, results):
+        if not succeeded:
+            fly_message(f"Failed to {action}. Continuing anyway...", "warning")
+            failed_actions.add(action)
+    
+    for name, prune_step in prune_steps.items():
+        if {f"export {name}", f"convert {name} to TSV"} & failed_actions:
+            continue
+        # In-process exports are recorded by their own step. A CLI export's biom file won't be
+        # there on rerun, so its table is recorded as done through the pruning step instead
+        if prune_step.command() and not in_process:
+            record_step(prune_step)
+            add_to_plan(f"Remove the {name} biom file", ["rm", "-f", prune_step.command.args[0]])
+    
+    if failed_actions:
+        fly_message("Some artifacts could not be exported, the rest are in the 'exports' directory", "warning")
+    else:
+        fly_message("All artifacts have been exported to the 'exports' directory!", "success")
     
     # Final message
     fly_message("\n===== ANALYSIS COMPLETE =====", "success")
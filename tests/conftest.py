@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import grigsby_qiime2_script as script
+
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    """Run each test in its own directory, with no step record or SLURM settings carried over"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(script, "_state_cache", None)
+    monkeypatch.setattr(script, "PLAN_SCRIPT", None)
+    monkeypatch.setattr(script, "BATCH_MANIFEST", None)
+    monkeypatch.setattr(script, "SRUN", None)
+    script._dir_cache.clear()
+    yield
+    script._dir_cache.clear()
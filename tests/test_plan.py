@@ -0,0 +1,62 @@
+import functools
+import os
+import subprocess
+
+import grigsby_qiime2_script as script
+
+
+def test_shell_commands_for_in_process_exports():
+    export = script.build_command(
+        functools.partial(script.export_feature_table, "table.qza", None, ["exports/t/feature-table.tsv", "exports/t/feature-table.tsv.gz"]),
+        "export",
+    )
+    assert script._shell_commands(export) == [
+        ["qiime", "tools", "export", "--input-path", "table.qza", "--output-path", "exports/t"],
+        ["biom", "convert", "-i", "exports/t/feature-table.biom", "-o", "exports/t/feature-table.tsv", "--to-tsv"],
+        ["gzip", "-1", "-f", "-k", "exports/t/feature-table.tsv"],
+        ["rm", "-f", "exports/t/feature-table.biom"],
+    ]
+
+    convert = script.build_command(
+        functools.partial(script.convert_biom_to_tsv, "exports/t/feature-table.biom", ["exports/t/feature-table.tsv.gz"]),
+        "convert",
+    )
+    assert script._shell_commands(convert) == [
+        ["biom", "convert", "-i", "exports/t/feature-table.biom", "-o", "exports/t/feature-table.tsv", "--to-tsv"],
+        ["gzip", "-1", "-f", "exports/t/feature-table.tsv"],
+    ]
+
+
+def test_plan_runs_steps_in_dependency_waves(monkeypatch):
+    monkeypatch.setattr(script, "PLAN_SCRIPT", "plan.sh")
+    script.start_plan_script("plan.sh")
+    steps = [
+        script.build_command(["sh", "-c", "echo a > a.txt"], "make a", outputs=["a.txt"]),
+        script.build_command(["sh", "-c", "echo b > b.txt"], "make b", outputs=["b.txt"]),
+        script.build_command(["sh", "-c", "cat a.txt b.txt > c.txt"], "join", inputs=["a.txt", "b.txt"], outputs=["c.txt"]),
+    ]
+    script._append_to_plan(steps)
+    script.add_to_plan("Tidy up", ["rm", "a.txt"])
+
+    with open("plan.sh") as f:
+        plan = f.read()
+    assert "sh -c 'echo a > a.txt' &\npids+=($!)\n" in plan
+    assert "sh -c 'cat a.txt b.txt > c.txt'\n" in plan
+    assert plan.index("make b") < plan.index('wait "$pid"') < plan.index("join") < plan.index("rm a.txt")
+
+    subprocess.run(["bash", "plan.sh"], check=True)
+    with open("c.txt") as f:
+        assert f.read() == "a\nb\n"
+
+
+def test_failing_background_command_stops_the_plan(monkeypatch):
+    monkeypatch.setattr(script, "PLAN_SCRIPT", "plan.sh")
+    script.start_plan_script("plan.sh")
+    script._append_to_plan([
+        script.build_command(["sh", "-c", "exit 3"], "fail", outputs=["a.txt"]),
+        script.build_command(["true"], "ok", outputs=["b.txt"]),
+        script.build_command(["touch", "c.txt"], "after", inputs=["a.txt"], outputs=["c.txt"]),
+    ])
+
+    assert subprocess.run(["bash", "plan.sh"]).returncode != 0
+    assert not os.path.exists("c.txt")
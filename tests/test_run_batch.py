@@ -0,0 +1,63 @@
+import functools
+import os
+
+import grigsby_qiime2_script as script
+
+
+def sh(command, description, inputs=(), outputs=()):
+    return script.build_command(["sh", "-c", command], description, inputs, outputs)
+
+
+def test_step_waits_for_the_step_producing_its_input():
+    producer = sh("sleep 0.2 && echo data > a.txt", "producer", outputs=["a.txt"])
+    consumer = sh("cp a.txt b.txt", "consumer", inputs=["a.txt"], outputs=["b.txt"])
+
+    assert script.run_batch([producer, consumer]) == [True, True]
+    with open("b.txt") as f:
+        assert f.read() == "data\n"
+
+
+def test_independent_steps_run_concurrently():
+    steps = [sh(f"sleep 0.5 && touch {name}", name, outputs=[name]) for name in ["a", "b", "c"]]
+
+    assert script.run_batch(steps, max_workers=3) == [True, True, True]
+    # All three finish within roughly one sleep
+    mtimes = [os.stat(name).st_mtime for name in ["a", "b", "c"]]
+    assert max(mtimes) - min(mtimes) < 0.4
+
+
+def test_steps_after_a_failure_are_skipped():
+    failing = sh("exit 1", "failing", outputs=["a.txt"])
+    downstream = sh("touch b.txt", "downstream", inputs=["a.txt"], outputs=["b.txt"])
+    further = sh("touch c.txt", "further", inputs=["b.txt"], outputs=["c.txt"])
+    independent = sh("touch d.txt", "independent", outputs=["d.txt"])
+
+    assert script.run_batch([failing, downstream, further, independent]) == [False, False, False, True]
+    assert not os.path.exists("b.txt")
+    assert not os.path.exists("c.txt")
+
+
+def test_callables_run_in_process():
+    def write(path, text):
+        with open(path, "w") as f:
+            f.write(text)
+
+    def fail():
+        raise ValueError("bad table")
+
+    steps = [
+        script.build_command(functools.partial(write, "a.txt", "hi"), "write", outputs=["a.txt"]),
+        script.build_command(fail, "fail", outputs=["b.txt"]),
+    ]
+    assert script.run_batch(steps) == [True, False]
+
+
+def test_successful_steps_are_recorded():
+    step = sh("touch a.txt", "touch", outputs=["a.txt"])
+    unrecorded = sh("touch b.txt", "unrecorded", outputs=["b.txt"])
+    unrecorded.record = False
+
+    script.run_batch([step, unrecorded])
+
+    state_cache = script._load_state_cache()
+    assert state_cache == {script.step_key(step): ["a.txt"]}
@@ -0,0 +1,73 @@
+import json
+import os
+import stat
+
+import pytest
+
+import grigsby_qiime2_script as script
+
+
+def install(bin_dir, name, body):
+    path = bin_dir / name
+    path.write_text(f"#!/bin/sh\n{body}\n")
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+
+
+@pytest.fixture
+def slurm(tmp_path, monkeypatch):
+    """Stub sbatch, sacct and scancel; sacct prints the files sacct.1, sacct.2, ... in turn"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    install(bin_dir, "sbatch", 'cat > "job-$(ls | grep -c "^job-")"\necho "42;cluster"')
+    install(bin_dir, "sacct", 'n=$(($(cat calls 2>/dev/null || echo 0) + 1)); echo $n > calls\n'
+                              'f=sacct.$n; [ -f $f ] || f=$(ls sacct.* | grep -v exit | sort -t. -k2 -n | tail -1)\n'
+                              'cat $f; exit $(cat $f.exit 2>/dev/null || echo 0)')
+    install(bin_dir, "scancel", 'echo "$@" > cancelled')
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(script, "SLURM_POLL_SECONDS", 0)
+    monkeypatch.setattr(script, "BATCH_MANIFEST", "manifest.jsonl")
+    return tmp_path
+
+
+def make_jobs(count):
+    return [script.build_command(["touch", f"out{i}"], f"job {i}", outputs=[f"out{i}"]) for i in range(count)]
+
+
+def test_waits_for_every_task_and_reads_their_states(slurm):
+    (slurm / "sacct.1").write_text("42_[0-2%2]|PENDING\n")
+    (slurm / "sacct.2").write_text("42_0|COMPLETED\n42_1|RUNNING\n42_[2]|PENDING\n")
+    (slurm / "sacct.3").write_text("42_0|COMPLETED\n42_1|FAILED\n42_2|CANCELLED by 1000\n")
+    (slurm / "slurm-42_1.out").write_text("Plugin error: bad table\n")
+
+    results = script._run_slurm_array(make_jobs(3), 2)
+
+    assert results[0] == (0, "")
+    assert results[1][0] is None
+    assert "ended in state FAILED" in results[1][1]
+    assert "Plugin error: bad table" in results[1][1]
+    assert "ended in state CANCELLED" in results[2][1]
+    assert (slurm / "calls").read_text().strip() == "3"
+
+
+def test_gives_up_and_cancels_when_sacct_keeps_failing(slurm):
+    (slurm / "sacct.1").write_text("")
+    (slurm / "sacct.1.exit").write_text("1")
+
+    results = script._run_slurm_array(make_jobs(2), 2)
+
+    assert all(returncode is None and "cancelled" in details for returncode, details in results)
+    assert (slurm / "cancelled").read_text().strip() == "42"
+    assert (slurm / "calls").read_text().strip() == str(script.SLURM_POLL_MAX_FAILURES)
+
+
+def test_each_array_is_indexed_from_zero(slurm):
+    (slurm / "sacct.1").write_text("42_0|COMPLETED\n42_1|COMPLETED\n")
+    script._run_slurm_array(make_jobs(2), 2)
+    script._run_slurm_array(make_jobs(2), 2)
+
+    for job_script, first_line in [("job-0", 1), ("job-1", 3)]:
+        text = (slurm / job_script).read_text()
+        assert "#SBATCH --array=0-1%2" in text
+        assert f"$((SLURM_ARRAY_TASK_ID + {first_line}))p" in text
+    with open("manifest.jsonl") as f:
+        assert [json.loads(line)["cmd"] for line in f] == ["touch out0", "touch out1"] * 2
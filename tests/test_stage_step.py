@@ -0,0 +1,33 @@
+import functools
+
+import grigsby_qiime2_script as script
+
+
+def test_stage_step_moves_outputs_and_staged_inputs_to_scratch():
+    export = script.build_command(
+        ["qiime", "tools", "export", "--input-path", "table.qza", "--output-path", "exports/feature-table"],
+        "export",
+        inputs=["table.qza"],
+        outputs=["exports/feature-table/feature-table.biom"],
+    )
+    convert = script.build_command(
+        functools.partial(script.convert_biom_to_tsv, "exports/feature-table/feature-table.biom", ["exports/feature-table/feature-table.tsv"]),
+        "convert",
+        inputs=["exports/feature-table/feature-table.biom"],
+        outputs=["exports/feature-table/feature-table.tsv"],
+    )
+
+    staged_export = script.stage_step(export, "exports", "/scratch", set())
+    assert staged_export.command == [
+        "qiime", "tools", "export", "--input-path", "table.qza", "--output-path", "/scratch/exports/feature-table",
+    ]
+    assert staged_export.inputs == ["table.qza"]
+    assert staged_export.outputs == ["/scratch/exports/feature-table/feature-table.biom"]
+    assert not staged_export.record
+
+    # The biom file is read from scratch only if it is written there by an earlier staged step
+    staged_convert = script.stage_step(convert, "exports", "/scratch", set(export.outputs))
+    assert staged_convert.command.args == ("/scratch/exports/feature-table/feature-table.biom", ["/scratch/exports/feature-table/feature-table.tsv"])
+    assert staged_convert.inputs == ["/scratch/exports/feature-table/feature-table.biom"]
+    kept_convert = script.stage_step(convert, "exports", "/scratch", set())
+    assert kept_convert.command.args == ("exports/feature-table/feature-table.biom", ["/scratch/exports/feature-table/feature-table.tsv"])
@@ -0,0 +1,97 @@
+import json
+import os
+
+import grigsby_qiime2_script as script
+
+
+def write(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def make_step(command=("qiime", "demux", "summarize"), inputs=("in.qza",), outputs=("out.qzv",)):
+    return script.build_command(list(command), "step", inputs, outputs)
+
+
+def test_key_changes_when_an_input_changes():
+    write("in.qza", "a")
+    step = make_step()
+    key = script.step_key(step)
+
+    write("in.qza", "ab")
+    assert script.step_key(step) != key
+
+
+def test_key_ignores_thread_counts():
+    write("in.qza", "a")
+    one = make_step(command=["qiime", "dada2", "denoise-paired", "--p-n-threads", "1"])
+    eight = make_step(command=["qiime", "dada2", "denoise-paired", "--p-n-threads", "8"])
+    other = make_step(command=["qiime", "dada2", "denoise-paired", "--p-trunc-len-f", "8"])
+
+    assert script.step_key(one) == script.step_key(eight)
+    assert script.step_key(one) != script.step_key(other)
+
+
+def test_key_covers_files_in_an_input_directory():
+    os.mkdir("reads")
+    write("reads/sample.fastq.gz", "a")
+    step = make_step(inputs=["reads"])
+    key = script.step_key(step)
+    directory_mtime = os.stat("reads").st_mtime_ns
+
+    # Rewrite the file with the same size and a new mtime; the directory's own mtime doesn't change
+    write("reads/sample.fastq.gz", "b")
+    os.utime("reads/sample.fastq.gz", ns=(1, 1))
+    assert os.stat("reads").st_mtime_ns == directory_mtime
+    assert script.step_key(step) != key
+
+
+def test_recorded_step_is_up_to_date_until_its_inputs_change():
+    write("in.qza", "a")
+    step = make_step()
+    assert not script.is_up_to_date(step)
+
+    write("out.qzv", "result")
+    script.record_step(step)
+    script._dir_cache.clear()
+    assert script.is_up_to_date(step)
+
+    write("in.qza", "changed")
+    assert not script.is_up_to_date(step)
+
+
+def test_missing_outputs_are_never_up_to_date():
+    write("in.qza", "a")
+    step = make_step()
+    script.record_step(step)
+    assert not script.is_up_to_date(step)
+
+
+def test_outputs_without_a_record_are_trusted():
+    # Outputs made before there was a record of them are kept
+    write("in.qza", "a")
+    write("out.qzv", "old result")
+    assert script.is_up_to_date(make_step())
+
+
+def test_outputs_recorded_for_another_command_are_not_trusted():
+    write("in.qza", "a")
+    write("out.qzv", "result")
+    script.record_step(make_step(command=["qiime", "demux", "summarize", "--p-n", "1"]))
+    script._dir_cache.clear()
+
+    assert not script.is_up_to_date(make_step(command=["qiime", "demux", "summarize", "--p-n", "2"]))
+
+
+def test_record_replaces_entries_for_the_same_outputs():
+    write("in.qza", "a")
+    write("out.qzv", "result")
+    first = make_step(command=["qiime", "a"])
+    second = make_step(command=["qiime", "b"])
+
+    script.record_step(first)
+    script.record_step(second)
+
+    with open(script.STATE_CACHE) as f:
+        assert json.load(f) == {script.step_key(second): ["out.qzv"]}
+    assert not os.path.exists(f"{script.STATE_CACHE}.tmp")
@@ -0,0 +1,46 @@
+import gzip
+import os
+
+import pytest
+
+import grigsby_qiime2_script as script
+
+biom = pytest.importorskip("biom")
+np = pytest.importorskip("numpy")
+
+
+def make_table():
+    return biom.Table(
+        np.array([[0, 1, 2], [3, 4, 5]]),
+        ["ASV1", "ASV2"],
+        ["S1", "S2", "S3"],
+    )
+
+
+def test_write_plain_and_gzip_from_one_pass(tmp_path):
+    table = make_table()
+    tsv_path = str(tmp_path / "feature-table.tsv")
+    gz_path = str(tmp_path / "feature-table.tsv.gz")
+
+    script.write_table_tsv(table, [tsv_path, gz_path])
+
+    with open(tsv_path) as f:
+        plain = f.read()
+    with gzip.open(gz_path, "rt") as f:
+        compressed = f.read()
+    assert plain == compressed
+    # Streaming ends every row with a newline, including the last one
+    assert plain == table.to_tsv() + "\n"
+    assert sorted(os.listdir(tmp_path)) == ["feature-table.tsv", "feature-table.tsv.gz"]
+
+
+def test_failed_write_leaves_no_files(tmp_path):
+    class BrokenTable:
+        def to_tsv(self, direct_io):
+            direct_io.writelines(["# Constructed from biom file\n"])
+            raise RuntimeError("disk full")
+
+    paths = [str(tmp_path / "feature-table.tsv"), str(tmp_path / "feature-table.tsv.gz")]
+    with pytest.raises(RuntimeError):
+        script.write_table_tsv(BrokenTable(), paths)
+    assert os.listdir(tmp_path) == []